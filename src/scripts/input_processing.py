@@ -16,12 +16,11 @@ Outputs:
 # Environment
 import sys
 import os
-import ndjson
+import orjson
 import json
 import pathlib
 import csv
 import logging
-import traceback
 import datetime
 
 ##################
@@ -38,10 +37,25 @@ model_metadata_log_file = base_path / "attachments" / "info.html"
 logging_path = base_path / "attachments" / "execution_log.log"
 attachments_json_path = base_path / "attachments.json"
 
+# Columns written to sample.csv, in order
+NEEDED_KEYS = (
+  'id',
+  'sub_administrative_area_id',
+  'season_year',
+  'species',
+  'age_group',
+  'sex',
+  'date_harvested',
+  'result',
+  'geolocation_precision',
+  'latitude',
+  'longitude'
+  )
+
 ###################
 # FUNCTIONS
 
-def model_log_html(line='', html_element="p", filename=model_metadata_log_file):
+def model_log_html(line='', html_element="p", filename=model_metadata_log_file, file=None):
     """
     Writes a single line to the model_metadata_log text file with specified HTML element.
 
@@ -49,7 +63,11 @@ def model_log_html(line='', html_element="p", filename=model_metadata_log_file):
         line: The line to be written.
         filename: The name of the file.
         html_element: The HTML element tag to use (e.g., "h1", "h2", "p", "div").
+        file: An already open file handle to write to instead of opening filename.
     """
+    if file is not None:
+        file.write(f"<{html_element}>{line}</{html_element}>" + '\n')
+        return
     with open(filename, 'a') as f:
         f.write(f"<{html_element}>{line}</{html_element}>" + '\n')
 
@@ -65,37 +83,36 @@ def dict_to_html_list(data, list_type='unordered'):
     An HTML string representing the dictionary.
   """
 
-  def _dict_to_html_helper(data):
+  if list_type == 'unordered':
+    open_tag, close_tag = "<ul>", "</ul>"
+  elif list_type == 'ordered':
+    open_tag, close_tag = "<ol>", "</ol>"
+  else:
+    raise ValueError("Invalid list_type. Use 'unordered' or 'ordered'.")
+
+  def _dict_to_html_helper(data, out):
     """Recursive helper function to handle nested dictionaries."""
-    html_str = ""
-    if list_type == 'unordered':
-      html_str += "<ul>"
-    elif list_type == 'ordered':
-      html_str += "<ol>"
-    else:
-      raise ValueError("Invalid list_type. Use 'unordered' or 'ordered'.")
+    out.append(open_tag)
 
     for key, value in data.items():
-      html_str += f"<li>{key}: "
+      out.append(f"<li>{key}: ")
       if isinstance(value, dict):
-        html_str += _dict_to_html_helper(value)
+        _dict_to_html_helper(value, out)
       elif isinstance(value, list):
-        html_str += "<ul>"
+        out.append("<ul>")
         for item in value:
-          html_str += f"<li>{item}</li>"
-        html_str += "</ul>"
+          out.append(f"<li>{item}</li>")
+        out.append("</ul>")
       else:
-        html_str += f"{value}"
-      html_str += "</li>"
+        out.append(f"{value}")
+      out.append("</li>")
 
-    if list_type == 'unordered':
-      html_str += "</ul>"
-    elif list_type == 'ordered':
-      html_str += "</ol>"
+    out.append(close_tag)
 
-    return html_str
-
-  return _dict_to_html_helper(data)
+  # Collect fragments in a list and join once rather than concatenating strings
+  out = []
+  _dict_to_html_helper(data, out)
+  return ''.join(out)
 
 def rename_key(dict_, old_key, new_key):
   """Renames a key in a dictionary.
@@ -144,19 +161,72 @@ def add_item_to_json_file_list(file_path, new_item):
     print(f"Error: {e}")
     raise
 
-def add_missing_defaults_inplace(original_dict, default_values):
+def transform_sample(sample):
   """
-  Adds missing key-value pairs from a default values dictionary to the original dictionary 
-  in-place.
+  Derives the sample.csv row for a single Warehouse sample.
 
   Args:
-    original_dict: The dictionary to which default values will be added.
-    default_values: A dictionary containing default key-value pairs.
+    sample: A sample record parsed from sample.ndJson. It is not modified.
+
+  Returns:
+    A tuple of column values in NEEDED_KEYS order. Values that cannot be
+    derived are None and are written as empty cells.
   """
 
-  for key, value in default_values.items():
-    if key not in original_dict:
-      original_dict[key] = value
+  # id
+  _id = sample.get('_id')
+
+  # Set sub_administrative_area_id
+  sub_area = sample.get('_sub_administrative_area')
+  sub_id = sub_area.get('_id') if isinstance(sub_area, dict) else None
+  
+  # Set date_harvested
+  # Keep only the date portion of the ISO timestamp (e.g. 2020-11-03T00:00:00.000Z).
+  # Slicing avoids strptime's format parsing; malformed values are left as-is.
+  dh = sample.get('date_harvested')
+  if isinstance(dh, str) and len(dh) >= 10 and dh[4] == '-' and dh[7] == '-':
+    dh = dh[:10]
+
+  # Set result
+  # Use the result of the single test flagged as selected_definitive. Stop at a
+  # second flagged test since the result is ambiguous in that case.
+  found = None
+  multiple = False
+  for test in sample.get('tests') or ():
+    if test.get('selected_definitive'):
+      if found is not None:
+        multiple = True
+        break
+      found = test
+  # result is a required field; but check if has value. If so, use it, else set to None
+  result = found.get('result') if (found is not None and not multiple) else None
+
+  # Set geolocation_precision, latitude, and longitude
+  # Nested keys are navigated with get() so samples missing them don't raise
+  geolocation_precision = None
+  lat = None
+  lon = None
+  lat_lng = sample.get('lat_lng')
+  if isinstance(lat_lng, dict):
+    props = lat_lng.get('properties') or {}
+    geolocation_precision = props.get('geolocation_precision')
+    geom = lat_lng.get('geometry') or {}
+    coords = geom.get('coordinates') or (None, None)
+    lon, lat = coords[0], coords[1]
+
+  return (
+    _id,
+    sub_id,
+    sample.get('season_year'),
+    sample.get('species'),
+    sample.get('age_group'),
+    sample.get('sex'),
+    dh,
+    result,
+    geolocation_precision,
+    lat,
+    lon
+    )
 
 ######################
 # SETUP FILE STRUCTURE
@@ -164,25 +234,23 @@ def add_missing_defaults_inplace(original_dict, default_values):
 # Create the attachments directory structure recursively if it doesn't already exist.
 os.makedirs(os.path.dirname(model_metadata_log_file), exist_ok=True)
 
-# Create attachments.json file which will contain a list of all attachments generated
-# Initially, the attachments is simply an empty list
-with open(attachments_json_path, 'w', newline='') as f:
-  writer = json.dump(list(), f)
-
-# Append execution log to attachments.json for developer feedback
-attachment = {
-  "filename": "execution_log.log", 
-  "content_type": "text/plain", 
-  "role": "downloadable"
+# Create attachments.json file which will contain a list of all attachments generated.
+# It is seeded with the execution log (for developer feedback) and the info log
+# (for user feedback) and written in a single dump.
+attachments = [
+  {
+    "filename": "execution_log.log", 
+    "content_type": "text/plain", 
+    "role": "downloadable"
+  },
+  {
+    "filename": "info.html", 
+    "content_type": "text/html", 
+    "role": "feedback"
   }
-add_item_to_json_file_list(attachments_json_path, attachment)
-
-# append info log to the attachments.json for user feedback
-attachment = {
-  "filename": "info.html", 
-  "content_type": "text/html", 
-  "role": "feedback"}
-add_item_to_json_file_list(attachments_json_path, attachment)
+  ]
+with open(attachments_json_path, 'w', newline='') as f:
+  json.dump(attachments, f, indent=2)
 
 ###############
 # SETUP LOGGING
@@ -190,10 +258,18 @@ add_item_to_json_file_list(attachments_json_path, attachment)
 # Create log file including any parent folders (if they don't already exist)
 os.makedirs(os.path.dirname(logging_path), exist_ok=True)
 
-logging.basicConfig(level = logging.DEBUG, # Alternatively, could use DEBUG, INFO, WARNING, ERROR, CRITICAL
+# Log level can be set with the LOG_LEVEL environment variable (DEBUG, INFO, WARNING, ERROR, CRITICAL).
+# Records below the level are discarded before any formatting is done.
+# Unrecognised names fall back to INFO.
+log_level = logging.getLevelName(os.environ.get('LOG_LEVEL', 'INFO').upper())
+if not isinstance(log_level, int):
+  log_level = logging.INFO
+
+logging.basicConfig(level = log_level,
                     filename = logging_path, 
                     filemode = 'w', # a is append, w is overbite
                     datefmt = '%Y-%m-%d %H:%M:%S',
+                    # Dropping %(asctime)s would cut per-record formatting cost if ever needed
                     format = '%(asctime)s - %(levelname)s - %(message)s')
 
 # Uncaught exception handler
@@ -211,161 +287,111 @@ sys.excepthook = handle_uncaught_exception
 
 # Initiate model metadata log
 
-# Clear model log file contents if necessary.
-open(model_metadata_log_file, 'w').close()
-model_log_html("Model Execution Summary", "h3")
-model_log_html("Model: Disease Cluster Analysis Data Export")
-model_log_html('Date: ' + datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ' GMT')
+now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+# Clear model log file contents if necessary and write the header with one open.
+with open(model_metadata_log_file, 'w') as log_f:
+  model_log_html("Model Execution Summary", "h3", file=log_f)
+  model_log_html("Model: Disease Cluster Analysis Data Export", file=log_f)
+  model_log_html('Date: ' + now_str + ' GMT', file=log_f)
 logging.info("Model: Disease Cluster Analysis Data Export")
-logging.info('Date: ' + datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ' GMT')
+logging.info('Date: ' + now_str + ' GMT')
 logging.info("This log records data for debugging purposes in the case of a model execution error.")
 
 ####################
 # Process Parameters
 
-# Get model parameters file
-try:
-  with open(parameters_file_path, 'r') as f:
-    params = json.load(f)
-    logging.info("Parameter file loaded successfully")
-except FileNotFoundError:
-  # The model cannot be executed without a params file. Exit with an error immediately.
-  logging.error("params.json File does not exist.")
-  model_log_html("ERROR", "h4")
-  model_log_html("Parameters (params.json) file not found.")
-  sys.exit(1)
-
-# Get provider admin area
-provider_admin_area = params['_provider']['_administrative_area']['administrative_area']
-# Remove Provider parameter, which is not used in this model and is nested
-del(params['_provider'])
-
-# Merge the list of season_year values into a single string
-if 'season_year' in params:
-  params['season_year'] = ', '.join(params['season_year'])
-
-# Write revised parameters to a CSV file
-with open(pathlib.Path(base_path / "params.csv"), 'w', newline='') as f:
-  field_names = params.keys()
-  writer = csv.DictWriter(
-    f, 
-    quoting=csv.QUOTE_NONNUMERIC,
-    fieldnames=field_names, 
-    extrasaction='ignore')
-  writer.writeheader()
-  writer.writerow(params)
-  
-# Add parameter related content to the log
-model_log_html(f'Provider area: {provider_admin_area}')
-model_log_html('User provided parameters', "h4")
-model_log_html(dict_to_html_list(params))
+def load_and_write_params():
+  """
+  Loads params.json, writes the revised parameters to params.csv and returns them.
+  Exits with an error if params.json does not exist.
+
+  Returns:
+    A tuple of the revised parameters dictionary and the provider administrative area.
+  """
+
+  # Get model parameters file
+  try:
+    with open(parameters_file_path, 'rb') as f:
+      params = orjson.loads(f.read())
+      logging.info("Parameter file loaded successfully")
+  except FileNotFoundError:
+    # The model cannot be executed without a params file. Exit with an error immediately.
+    logging.error("params.json File does not exist.")
+    model_log_html("ERROR", "h4")
+    model_log_html("Parameters (params.json) file not found.")
+    sys.exit(1)
+
+  # Get provider admin area
+  provider_admin_area = params['_provider']['_administrative_area']['administrative_area']
+  # Remove Provider parameter, which is not used in this model and is nested
+  del(params['_provider'])
+
+  # Merge the list of season_year values into a single string
+  if 'season_year' in params:
+    params['season_year'] = ', '.join(params['season_year'])
+
+  # Write revised parameters to a CSV file
+  with open(pathlib.Path(base_path / "params.csv"), 'w', newline='') as f:
+    # One header row and one value row, both in params' key order
+    writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerow(params.keys())
+    writer.writerow(params.values())
+
+  return params, provider_admin_area
 
 #################
 # Process Samples
 
-try:
-  with open(sample_file_path, 'r') as f:
-    samples = ndjson.load(f)
-    logging.info("Sample file loaded successfully")
+def load_and_write_samples():
+  """
+  Streams sample.ndJson through transform_sample into sample.csv.
+  Exits with an error if sample.ndJson does not exist.
 
-except (FileNotFoundError):
-  logging.error("sample.ndJson file does not exist.")
-  model_log_html("ERROR", "h4")
-  model_log_html("Samples (sample.ndJson) file not found. Sample data are required to run this model. Execution halted.")
-  sys.exit(1)
-  
-# Log number of samples provided by Warehouse to model
-model_log_html("Warehouse data provided to model", "h4")
-model_log_html("Samples: " + str(len(samples)))
-
-# Process samples
-for sample in samples:
-
-  # Add keys representing keys that may or may not already exist
-  needed_keys_with_defaults = {
-    'id':None,
-    'sub_administrative_area_id':None,
-    'season_year':None,
-    'species':None,
-    'age_group':None,
-    'sex':None,
-    "date_harvested":None,
-    'result':None,
-    'geolocation_precision':None,
-    'latitude':None,
-    'longitude':None
-    }
-  add_missing_defaults_inplace(sample, needed_keys_with_defaults)
+  Returns:
+    The number of samples written.
+  """
 
-  # id
   try:
-    sample['id'] = sample['_id']
-  except (KeyError, TypeError):
-    pass # leave it as none
+    sample_file = open(sample_file_path, 'rb')
+  except (FileNotFoundError):
+    logging.error("sample.ndJson file does not exist.")
+    model_log_html("ERROR", "h4")
+    model_log_html("Samples (sample.ndJson) file not found. Sample data are required to run this model. Execution halted.")
+    sys.exit(1)
+
+  # Parse, transform and write each sample in a single pass so the full sample
+  # set is never held in memory. orjson accepts bytes so no text decoding is needed.
+  sample_count = 0
+  with sample_file, open(pathlib.Path(base_path / "sample.csv"), 'w', newline='') as f:
+    # csv.writer is implemented in C; a hand-built format string with Python-level
+    # quoting benchmarked slower, so rows are handed to it directly.
+    writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerow(NEEDED_KEYS)
+    for line in sample_file:
+      if not line.strip():
+        continue
+      writer.writerow(transform_sample(orjson.loads(line)))
+      sample_count += 1
+
+  logging.info("Sample file loaded successfully")
+  return sample_count
+
+#########################
+# Run Parameters and Samples
+
+params, provider_admin_area = load_and_write_params()
 
-  # Set sub_administrative_area_id
-  try:
-    sample["sub_administrative_area_id"] = sample['_sub_administrative_area']['_id']
-  except (KeyError, TypeError):
-    pass
-  
-  # Set date_harvested
-  if "date_harvested" in sample and isinstance(sample["date_harvested"], str):
-    try:
-      sample["date_harvested"] = datetime.datetime.strptime(sample['date_harvested'], '%Y-%m-%dT%H:%M:%S.%fZ').strftime('%Y-%m-%d')
-    except ValueError: # Input does not match the specified format
-      pass 
-    type(None).__str__
+# Add parameter related content to the log
+model_log_html(f'Provider area: {provider_admin_area}')
+model_log_html('User provided parameters', "h4")
+model_log_html(dict_to_html_list(params))
 
-  # Set result
-  if 'tests' in sample and len(sample['tests']) > 0:
-    # Create a list of tests that are flagged as selected_definitive (should have length 0 or 1)
-    
-    tests_selected_definitive = [test for test in sample["tests"] if "selected_definitive" in test and test["selected_definitive"] == True]
-    if len(tests_selected_definitive) == 1: # one match so use that test
-      # result is a required field; but check if has value. If so, use it, else set to None
-      try:
-        sample["result"] = tests_selected_definitive[0]["result"] 
-      except (KeyError, TypeError, ValueError): 
-        pass
-    else: 
-      sample["result"] = None
-  else:
-    sample["result"] = None
+sample_count = load_and_write_samples()
 
-  # Set geolocation_precision, latitude, and longitude
-  if "lat_lng" in sample:
-    try: # Using try b/c nested keys
-      sample['geolocation_precision'] = sample["lat_lng"]['properties']['geolocation_precision'] 
-    except (KeyError, TypeError): 
-      sample['geolocation_precision'] = None
-    try: # Using try b/c nested keys
-      sample["longitude"] = sample["lat_lng"]["geometry"]["coordinates"][0]
-      sample["latitude"] = sample["lat_lng"]["geometry"]["coordinates"][1]      
-    except (KeyError, TypeError): 
-      sample["longitude"] = None
-      sample["latitude"] = None
-
-# Write to a CSV
-with open(pathlib.Path(base_path / "sample.csv"), 'w', newline='') as f:
-  writer = csv.DictWriter(
-    f, 
-    quoting=csv.QUOTE_NONNUMERIC,
-    fieldnames=["id", 
-                "sub_administrative_area_id",
-                "season_year",
-                "species", 
-                "age_group",
-                "sex", 
-                "date_harvested",
-                "result", 
-                "geolocation_precision",
-                "latitude",
-                "longitude"
-                ], 
-    extrasaction='ignore')
-  writer.writeheader()
-  writer.writerows(samples)
-
-  logging.info("Model input processing successfully completed.")
-  sys.exit(0)
\ No newline at end of file
+# Log number of samples provided by Warehouse to model
+model_log_html("Warehouse data provided to model", "h4")
+model_log_html("Samples: " + str(sample_count))
+
+logging.info("Model input processing successfully completed.")
+sys.exit(0)
\ No newline at end of file